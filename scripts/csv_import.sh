@@ -9,24 +9,29 @@ DIR=$1
 DB_HOST=$2
 DB_KEYSPACE=$3
 
+# the tables are independent, load them concurrently
+pids=()
+
 dsbulk load -c csv -h "$DB_HOST" -k "$DB_KEYSPACE" -t block -url "$DIR" \
     --connector.csv.fileNamePattern '**/block_*.csv.gz' \
     --connector.csv.compression gzip \
-    --connector.csv.recursive true
+    --connector.csv.recursive true &
+pids+=($!)
 
 dsbulk load -c csv -h "$DB_HOST" -k "$DB_KEYSPACE" -t transaction -url "$DIR" \
     --connector.csv.fileNamePattern '**/tx_*.csv.gz' \
     --connector.csv.compression gzip \
     --connector.csv.recursive true \
-    --connector.csv.maxCharsPerColumn=-1
+    --connector.csv.maxCharsPerColumn=-1 &
+pids+=($!)
 
 dsbulk load -c csv -h "$DB_HOST" -k "$DB_KEYSPACE" -t trace -url "$DIR" \
     --connector.csv.fileNamePattern '**/trace_*.csv.gz' \
     --connector.csv.compression gzip \
     --connector.csv.recursive true \
     --schema.allowMissingFields true \
-    --connector.csv.maxCharsPerColumn=-1
-
+    --connector.csv.maxCharsPerColumn=-1 &
+pids+=($!)
 
 dsbulk load -c csv -h "$DB_HOST" -k "$DB_KEYSPACE" -t log -url "$DIR" \
     --connector.csv.fileNamePattern '**/logs_*.csv.gz' \
@@ -36,4 +41,11 @@ dsbulk load -c csv -h "$DB_HOST" -k "$DB_KEYSPACE" -t log -url "$DIR" \
     --connector.csv.maxCharsPerColumn 8388608 \
     --dsbulk.connector.csv.nullValue "" \
     --dsbulk.connector.csv.ignoreLeadingWhitespaces true \
-    --dsbulk.connector.csv.ignoreTrailingWhitespaces true
+    --dsbulk.connector.csv.ignoreTrailingWhitespaces true &
+pids+=($!)
+
+status=0
+for pid in "${pids[@]}"; do
+    wait "$pid" || status=1
+done
+exit $status
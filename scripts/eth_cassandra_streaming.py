@@ -4,81 +4,215 @@
 
    Ingest blocks, transactions/receipts and traces into Apache Cassandra.
 """
+import json
 import warnings
 from argparse import ArgumentParser
+from binascii import unhexlify
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from itertools import groupby
+from operator import itemgetter
+import random
+import threading
 import time
-from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
 
+from cassandra import OperationTimedOut, RequestExecutionException
 from cassandra.cluster import (
+    EXEC_PROFILE_DEFAULT,
     Cluster,
+    ExecutionProfile,
+    NoHostAvailable,
+    ResponseFuture,
     Session,
 )
-from cassandra.concurrent import execute_concurrent_with_args
-from cassandra.query import PreparedStatement, SimpleStatement, UNSET_VALUE
+from cassandra.metadata import protect_name
+from cassandra.policies import DCAwareRoundRobinPolicy, TokenAwarePolicy
+from cassandra.query import (
+    BatchStatement,
+    BatchType,
+    BoundStatement,
+    PreparedStatement,
+    Statement,
+    UNSET_VALUE,
+)
 from ethereumetl.jobs.export_blocks_job import ExportBlocksJob
 from ethereumetl.jobs.export_receipts_job import ExportReceiptsJob
 from ethereumetl.jobs.export_traces_job import ExportTracesJob
-from ethereumetl.providers.auto import get_provider_from_uri
+from ethereumetl.json_rpc_requests import generate_json_rpc
 from ethereumetl.service.eth_service import EthService
-from ethereumetl.streaming.enrich import enrich_transactions
-from ethereumetl.streaming.eth_item_id_calculator import EthItemIdCalculator
-from ethereumetl.streaming.eth_item_timestamp_calculator import (
-    EthItemTimestampCalculator,
-)
 from ethereumetl.thread_local_proxy import ThreadLocalProxy
 from web3 import Web3
-from typing import Union
+
+from eth_rpc import (
+    ExportBlockReceiptsJob,
+    get_batch_provider,
+    supports_block_receipts,
+)
 
 
 BLOCK_BUCKET_SIZE = 1_000
+DEFAULT_TIMEOUT = 60
+PROGRESS_INTERVAL = 10  # seconds between progress reports
+# single-row table holding the last ingested block, see schema.cql
+CHECKPOINT_TABLE = "ingest_checkpoint"
+# block groups below the client's head probed before scanning all groups
+HEAD_PROBE_GROUPS = 3
 TX_HASH_PREFIX_LEN = 5
 
+# transient errors (timeouts, unavailable/overloaded replicas) for which
+# writes are retried
+RETRYABLE_ERRORS = (RequestExecutionException, OperationTimedOut, NoHostAvailable)
+
+# table columns (in positional row order) and how they are derived from
+# the exported items, see compile_row_converter
+BLOCK_FIELDS = [
+    ("block_id_group", "expr", "item['number'] // block_bucket_size"),
+    ("block_id", "value", "number"),
+    ("block_hash", "blob", "hash"),
+    ("parent_hash", "blob", "parent_hash"),
+    ("nonce", "blob", "nonce"),
+    ("sha3_uncles", "blob", "sha3_uncles"),
+    ("logs_bloom", "blob", "logs_bloom"),
+    ("transactions_root", "blob", "transactions_root"),
+    ("state_root", "blob", "state_root"),
+    ("receipts_root", "blob", "receipts_root"),
+    ("miner", "blob", "miner"),
+    ("difficulty", "value", "difficulty"),
+    ("total_difficulty", "value", "total_difficulty"),
+    ("size", "value", "size"),
+    ("extra_data", "blob", "extra_data"),
+    ("gas_limit", "value", "gas_limit"),
+    ("gas_used", "value", "gas_used"),
+    ("base_fee_per_gas", "value", "base_fee_per_gas"),
+    ("timestamp", "value", "timestamp"),
+    ("transaction_count", "value", "transaction_count"),
+]
+
+TX_FIELDS = [
+    ("tx_hash_prefix", "expr", "item['hash'][2 : 2 + tx_hash_prefix_len]"),
+    ("tx_hash", "blob", "hash"),
+    ("nonce", "value", "nonce"),
+    ("block_hash", "blob", "block_hash"),
+    ("block_id", "value", "block_number"),
+    ("transaction_index", "value", "transaction_index"),
+    ("from_address", "blob", "from_address"),
+    ("to_address", "blob", "to_address"),
+    ("value", "value", "value"),
+    ("gas", "value", "gas"),
+    ("gas_price", "value", "gas_price"),
+    ("input", "blob", "input"),
+    ("block_timestamp", "value", "block_timestamp"),
+    ("max_fee_per_gas", "value", "max_fee_per_gas"),
+    ("max_priority_fee_per_gas", "value", "max_priority_fee_per_gas"),
+    ("transaction_type", "value", "transaction_type"),
+    ("receipt_cumulative_gas_used", "value", "receipt_cumulative_gas_used"),
+    ("receipt_gas_used", "value", "receipt_gas_used"),
+    ("receipt_contract_address", "blob", "receipt_contract_address"),
+    ("receipt_root", "blob", "receipt_root"),
+    ("receipt_status", "value", "receipt_status"),
+    ("receipt_effective_gas_price", "value", "receipt_effective_gas_price"),
+]
+
+TRACE_FIELDS = [
+    ("block_id_group", "expr", "item['block_number'] // block_bucket_size"),
+    ("block_id", "value", "block_number"),
+    ("tx_hash", "blob", "transaction_hash"),
+    ("transaction_index", "value", "transaction_index"),
+    ("from_address", "blob", "from_address"),
+    ("to_address", "blob", "to_address"),
+    ("value", "value", "value"),
+    ("input", "blob", "input"),
+    ("output", "blob", "output"),
+    ("trace_type", "value", "trace_type"),
+    ("call_type", "value", "call_type"),
+    ("reward_type", "value", "reward_type"),
+    ("gas", "value", "gas"),
+    ("gas_used", "value", "gas_used"),
+    ("subtraces", "value", "subtraces"),
+    (
+        "trace_address",
+        "expr",
+        "None if item['trace_address'] is None"
+        " else ','.join(map(str, item['trace_address']))",
+    ),
+    ("error", "value", "error"),
+    ("status", "value", "status"),
+    ("trace_id", "value", "trace_id"),
+    ("trace_index", "value", "trace_index"),
+]
+
+LOG_FIELDS = [
+    ("block_id_group", "expr", "item['block_number'] // block_bucket_size"),
+    ("block_id", "value", "block_number"),
+    ("block_hash", "blob", "block_hash"),
+    ("address", "blob", "address"),
+    ("data", "blob", "data"),
+    ("topics", "expr", "[hex_to_bytes(t) for t in item['topics'] or ()]"),
+    # bugfix do not use None for topic0 but 0x, None
+    # gets converted to UNSET which is not allowed for
+    # key columns in cassandra and can not be filtered
+    (
+        "topic0",
+        "expr",
+        "hex_to_bytes(item['topics'][0] if item['topics'] else '0x')",
+    ),
+    ("tx_hash", "blob", "transaction_hash"),
+    ("log_index", "value", "log_index"),
+    ("transaction_index", "value", "transaction_index"),
+]
 
-def none_to_unset(items: Union[dict, tuple, list]):
-    """Sets all None value to UNSET
-    See https://stackoverflow.com/questions/34637680/how-insert-in-cassandra-without-null-value-in-column
-
-    Args:
-        items (Union[dict, tuple, list]): items to insert
 
-    Returns:
-        None: -
+class InMemoryItemExporter:
+    """In-memory item exporter for EthStreamerAdapter export jobs.
 
-    Raises:
-        Exception: If datatype of items is not supported (list,tuple,dict)
+    Items of types with a converter are stored in converted form.
     """
-    if type(items) == dict:
-        return {k: (UNSET_VALUE if v is None else v) for k, v in items.items()}
-    elif type(items) == tuple:
-        return tuple([UNSET_VALUE if v is None else v for v in list(items)])
-    elif type(items) == list:
-        return [(UNSET_VALUE if v is None else v) for v in items]
-    else:
-        raise Exception(
-            f"Can't auto unset for type {type(items)} please assign "
-            "cassandra.query.UNSET_VALUE manually."
-        )
 
-
-class InMemoryItemExporter:
-    """In-memory item exporter for EthStreamerAdapter export jobs."""
-
-    def __init__(self, item_types: Iterable) -> None:
+    def __init__(
+        self,
+        item_types: Iterable,
+        converters: Optional[Dict[str, Callable]] = None,
+    ) -> None:
         self.item_types = item_types
+        self.converters = converters or {}
         self.items: Dict[str, List] = {}
+        self.appenders: Dict[str, Callable] = {}
 
     def open(self) -> None:
         """Open item exporter."""
         for item_type in self.item_types:
             self.items[item_type] = []
+        # bound append methods, one dict lookup per exported item
+        self.appenders = {}
+        for item_type, items in self.items.items():
+            convert = self.converters.get(item_type)
+            if convert is None:
+                self.appenders[item_type] = items.append
+            else:
+                # store converted item right away, so the exported dict
+                # can be freed while the job is still running
+                def append(item, append=items.append, convert=convert):
+                    append(convert(item))
+
+                self.appenders[item_type] = append
 
     def export_item(self, item) -> None:
         """Export single item."""
-        item_type = item.get("type", None)
-        if item_type is None:
-            raise ValueError(f"type key is not found in item {item}")
-        self.items[item_type].append(item)
+        self.appenders[item["type"]](item)
 
     def close(self) -> None:
         """Close item exporter."""
@@ -97,12 +231,21 @@ class EthStreamerAdapter:
         batch_web3_provider: ThreadLocalProxy,
         batch_size: int = 100,
         max_workers: int = 5,
+        receipts_batch_size: Optional[int] = None,
+        converters: Optional[Dict[str, Callable]] = None,
     ) -> None:
         self.batch_web3_provider = batch_web3_provider
+        # one Web3 instance for all export jobs; the jobs' worker threads
+        # are short-lived, requests go through their thread-local provider
+        self.web3 = Web3(batch_web3_provider)
+        self.converters = converters
         self.batch_size = batch_size
         self.max_workers = max_workers
-        self.item_id_calculator = EthItemIdCalculator()
-        self.item_timestamp_calculator = EthItemTimestampCalculator()
+        self.receipts_batch_size = (
+            batch_size if receipts_batch_size is None else receipts_batch_size
+        )
+        # probed on first receipt export
+        self.block_receipts: Optional[bool] = None
 
     def export_blocks_and_transactions(
         self,
@@ -114,7 +257,7 @@ class EthStreamerAdapter:
         """Export blocks and transactions for specified block range."""
 
         blocks_and_transactions_item_exporter = InMemoryItemExporter(
-            item_types=["block", "transaction"]
+            item_types=["block", "transaction"], converters=self.converters
         )
         blocks_and_transactions_job = ExportBlocksJob(
             start_block=start_block,
@@ -135,20 +278,42 @@ class EthStreamerAdapter:
     def export_receipts_and_logs(
         self, transactions: Iterable
     ) -> Tuple[Iterable, Iterable]:
-        """Export receipts and logs for specified transaction hashes."""
+        """Export receipts and logs for specified transactions.
 
-        exporter = InMemoryItemExporter(item_types=["receipt", "log"])
-        job = ExportReceiptsJob(
-            transaction_hashes_iterable=(
-                transaction["hash"] for transaction in transactions
-            ),
-            batch_size=self.batch_size,
-            batch_web3_provider=self.batch_web3_provider,
-            max_workers=self.max_workers,
-            item_exporter=exporter,
-            export_receipts=True,
-            export_logs=True,
+        Receipts are requested per block if the Ethereum client supports
+        eth_getBlockReceipts, otherwise per transaction hash.
+        """
+
+        block_numbers = sorted({tx["block_number"] for tx in transactions})
+        if self.block_receipts is None and block_numbers:
+            self.block_receipts = supports_block_receipts(
+                self.batch_web3_provider, block_numbers[0]
+            )
+        exporter = InMemoryItemExporter(
+            item_types=["receipt", "log"], converters=self.converters
         )
+        if self.block_receipts:
+            job = ExportBlockReceiptsJob(
+                block_numbers_iterable=block_numbers,
+                batch_size=self.batch_size,
+                batch_web3_provider=self.batch_web3_provider,
+                max_workers=self.max_workers,
+                item_exporter=exporter,
+                export_receipts=True,
+                export_logs=True,
+            )
+        else:
+            job = ExportReceiptsJob(
+                transaction_hashes_iterable=(
+                    transaction["hash"] for transaction in transactions
+                ),
+                batch_size=self.receipts_batch_size,
+                batch_web3_provider=self.batch_web3_provider,
+                max_workers=self.max_workers,
+                item_exporter=exporter,
+                export_receipts=True,
+                export_logs=True,
+            )
 
         job.run()
         receipts = exporter.get_items("receipt")
@@ -164,12 +329,14 @@ class EthStreamerAdapter:
     ) -> Iterable[Dict]:
         """Export traces for specified block range."""
 
-        exporter = InMemoryItemExporter(item_types=["trace"])
+        exporter = InMemoryItemExporter(
+            item_types=["trace"], converters=self.converters
+        )
         job = ExportTracesJob(
             start_block=start_block,
             end_block=end_block,
             batch_size=self.batch_size,
-            web3=ThreadLocalProxy(lambda: Web3(self.batch_web3_provider)),
+            web3=self.web3,
             max_workers=self.max_workers,
             item_exporter=exporter,
             include_genesis_traces=include_genesis_traces,
@@ -180,10 +347,107 @@ class EthStreamerAdapter:
         return traces
 
 
-def hex_to_bytearray(hex_str: str) -> Optional[bytearray]:
-    """Convert hexstring (starting with 0x) to bytearray."""
+def export_block_range(
+    adapter: EthStreamerAdapter,
+    start_block: int,
+    end_block: int,
+    transaction_to_row: Callable[[Dict], Tuple],
+    trace_executor: Executor,
+) -> Tuple[Iterable, Iterable, Iterable, Iterable]:
+    """Export block range and return rows of the block, transaction,
+    log and trace tables.
 
-    return bytearray.fromhex(hex_str[2:]) if hex_str is not None else None
+    Traces do not depend on blocks or receipts and are exported by
+    trace_executor while blocks, transactions and receipts are fetched.
+    """
+
+    traces_future = trace_executor.submit(
+        adapter.export_traces, start_block, end_block, True, True
+    )
+    blocks, txs = adapter.export_blocks_and_transactions(start_block, end_block)
+    receipts, logs = adapter.export_receipts_and_logs(txs)
+    traces = traces_future.result()
+    # receipts are exported as (transaction hash, receipt columns) pairs
+    receipts = dict(receipts)
+    tx_rows = []
+    for tx in txs:
+        receipt = receipts.get(tx["hash"])
+        if receipt is None:
+            raise ValueError(f"No receipt exported for transaction {tx['hash']}")
+        tx.update(receipt)
+        tx_rows.append(transaction_to_row(tx))
+    return blocks, tx_rows, logs, traces
+
+
+def timed(func: Callable, *args) -> Tuple[Any, float]:
+    """Call function and return its result and elapsed time in seconds."""
+
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+class BatchSizeTuner:
+    """Adapt the number of blocks per batch to the measured export
+    (JSON-RPC) and ingest (Cassandra) time per block."""
+
+    def __init__(
+        self,
+        min_batch_size: int,
+        max_batch_size: int,
+        smoothing: float = 0.3,
+        ratio: float = 1.5,
+        factor: float = 1.25,
+    ) -> None:
+        self.batch_size = min_batch_size
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max(min_batch_size, max_batch_size)
+        self.smoothing = smoothing
+        self.ratio = ratio
+        self.factor = factor
+        self.export_time: Optional[float] = None
+        self.ingest_time: Optional[float] = None
+
+    def update(self, num_blocks: int, export_time: float, ingest_time: float) -> int:
+        """Update moving averages of time per block and return new batch size.
+
+        Larger batches amortize JSON-RPC round-trips, so the batch size
+        grows while exporting dominates and shrinks while ingesting does.
+        """
+        export_time /= num_blocks
+        ingest_time /= num_blocks
+        if self.export_time is None or self.ingest_time is None:
+            self.export_time, self.ingest_time = export_time, ingest_time
+        else:
+            alpha = self.smoothing
+            self.export_time = alpha * export_time + (1 - alpha) * self.export_time
+            self.ingest_time = alpha * ingest_time + (1 - alpha) * self.ingest_time
+
+        batch_size = self.batch_size
+        if self.export_time > self.ratio * self.ingest_time:
+            batch_size = min(
+                self.max_batch_size,
+                max(batch_size + 1, int(batch_size * self.factor)),
+            )
+        elif self.ingest_time > self.ratio * self.export_time:
+            batch_size = max(self.min_batch_size, int(batch_size / self.factor))
+
+        if batch_size != self.batch_size:
+            print(
+                f"Batch size: {batch_size} blocks "
+                f"(export {self.export_time:.3f}s/block, "
+                f"ingest {self.ingest_time:.3f}s/block)"
+            )
+            self.batch_size = batch_size
+        return batch_size
+
+
+def hex_to_bytes(hex_str: str) -> Optional[bytes]:
+    """Convert hexstring (starting with 0x) to bytes."""
+
+    # binascii's decoder is notably faster than bytes.fromhex, which has to
+    # handle whitespace between digits
+    return unhexlify(hex_str[2:]) if hex_str is not None else None
 
 
 def build_cql_insert_stmt(columns: Sequence[str], table: str) -> str:
@@ -196,10 +460,9 @@ def build_cql_insert_stmt(columns: Sequence[str], table: str) -> str:
     )
 
 
-def get_last_block_yesterday(batch_web3_provider: ThreadLocalProxy) -> int:
+def get_last_block_yesterday(web3: Web3) -> int:
     """Return last block number of previous day from Ethereum client."""
 
-    web3 = Web3(batch_web3_provider)
     eth_service = EthService(web3)
 
     date = datetime.utcnow().replace(
@@ -216,19 +479,106 @@ def get_last_block_yesterday(batch_web3_provider: ThreadLocalProxy) -> int:
     return end_block
 
 
-def get_last_synced_block(batch_web3_provider: ThreadLocalProxy) -> int:
+def probe_rpc_batch_size(
+    batch_web3_provider: ThreadLocalProxy, max_batch_size: int
+) -> int:
+    """Return largest JSON-RPC batch size (halving from max_batch_size)
+    accepted by the Ethereum client."""
+
+    batch_size = max_batch_size
+    while batch_size > 1:
+        rpc = [
+            generate_json_rpc(method="eth_blockNumber", params=[], request_id=i)
+            for i in range(batch_size)
+        ]
+        try:
+            response = batch_web3_provider.make_batch_request(json.dumps(rpc))
+            if isinstance(response, list) and len(response) == batch_size:
+                if all("result" in elem for elem in response):
+                    return batch_size
+        except Exception as exception:
+            print(f"JSON-RPC batch size {batch_size} rejected: {exception}")
+        batch_size //= 2
+    return 1
+
+
+def get_last_synced_block(web3: Web3) -> int:
     """Return last synchronized block number from Ethereum client."""
 
-    return int(Web3(batch_web3_provider).eth.getBlock("latest").number)
+    return int(web3.eth.getBlock("latest").number)
+
+
+@lru_cache(maxsize=None)
+def get_prepared_query(session: Session, cql_str: str) -> PreparedStatement:
+    """Prepare CQL query, at most once per session."""
+
+    return session.prepare(cql_str)
+
+
+def has_checkpoint_table(session: Session) -> bool:
+    """Check whether the keyspace has the ingest checkpoint table."""
+
+    keyspace = session.cluster.metadata.keyspaces.get(session.keyspace)
+    return keyspace is not None and CHECKPOINT_TABLE in keyspace.tables
 
 
-def get_last_ingested_block(session: Session, table="block") -> Optional[int]:
-    """Return last ingested block ID from block table."""
+def get_checkpoint(session: Session, table: str = "block") -> Optional[int]:
+    """Return last ingested block ID recorded in the checkpoint table."""
 
-    cql_str = f"""SELECT block_id_group FROM {session.keyspace}.{table}
-                  PER PARTITION LIMIT 1"""
-    simple_stmt = SimpleStatement(cql_str, fetch_size=None)
-    result = session.execute(simple_stmt)
+    prepared_stmt = get_prepared_query(
+        session, f"SELECT last_block FROM {CHECKPOINT_TABLE} WHERE id=?"
+    )
+    row = session.execute(prepared_stmt, (table,)).one()
+    return None if row is None else row.last_block
+
+
+def store_checkpoint(session: Session, last_block: int, table: str = "block") -> None:
+    """Record last ingested block ID in the checkpoint table."""
+
+    prepared_stmt = get_prepared_statement(
+        session, CHECKPOINT_TABLE, ("id", "last_block")
+    )
+    session.execute(prepared_stmt, (table, last_block))
+
+
+def get_last_ingested_block(
+    session: Session, table="block", head: Optional[int] = None
+) -> Optional[int]:
+    """Return last ingested block ID, from the checkpoint table if
+    available, otherwise from the block table.
+
+    Given the client's head block, the block groups just below it are
+    queried first, before scanning the partitions of all block groups.
+    """
+
+    if has_checkpoint_table(session):
+        last_block = get_checkpoint(session, table)
+        if last_block is not None:
+            return last_block
+
+    table_name = f"{protect_name(session.keyspace)}.{protect_name(table)}"
+    # newest row of a block group, read from the end of the partition
+    # instead of aggregating over all of its rows
+    max_block_stmt = get_prepared_query(
+        session,
+        f"SELECT block_id FROM {table_name} WHERE block_id_group=? "
+        "ORDER BY block_id DESC LIMIT 1",
+    )
+
+    if head is not None:
+        head_group = head // BLOCK_BUCKET_SIZE
+        for group in range(head_group, head_group - HEAD_PROBE_GROUPS, -1):
+            if group < 0:
+                break
+            result = session.execute(max_block_stmt, (group,))
+            if result.current_rows:
+                return result.current_rows[0].block_id
+
+    groups_stmt = get_prepared_query(
+        session, f"SELECT block_id_group FROM {table_name} PER PARTITION LIMIT 1"
+    )
+    # fetch all partitions at once, without paging
+    result = session.execute(BoundStatement(groups_stmt, fetch_size=None))
     groups = [row.block_id_group for row in result.current_rows]
 
     if len(groups) == 0:
@@ -236,71 +586,139 @@ def get_last_ingested_block(session: Session, table="block") -> Optional[int]:
 
     max_block_group = max(groups)
 
-    result = session.execute(
-        f"""SELECT MAX(block_id) AS max_block FROM {session.keyspace}.{table}
-            WHERE block_id_group={max_block_group}"""
-    )
-    max_block = result.current_rows[0].max_block
-
-    return max_block
+    result = session.execute(max_block_stmt, (max_block_group,))
+    return result.current_rows[0].block_id
 
 
+@lru_cache(maxsize=None)
 def get_prepared_statement(
-    session: Session, keyspace: str, table: str
+    session: Session, table: str, columns: Tuple[str, ...]
 ) -> PreparedStatement:
-    """Build prepared CQL INSERT statement for specified table."""
+    """Build prepared CQL INSERT statement for specified table and columns.
+
+    Statements are cached per session, table and columns, so each insert
+    is prepared only once.
+    """
 
-    cql_str = f"""SELECT column_name FROM system_schema.columns
-                  WHERE keyspace_name = \'{keyspace}\'
-                  AND table_name = \'{table}\';"""
-    result_set = session.execute(cql_str)
-    columns = [elem.column_name for elem in result_set._current_rows]
     cql_str = build_cql_insert_stmt(columns, table)
     prepared_stmt = session.prepare(cql_str)
     return prepared_stmt
 
 
+def backoff_delay(attempt: int, base: float = 0.1, cap: float = 10.0) -> float:
+    """Return exponential backoff delay in seconds with random jitter."""
+
+    return min(cap, base * 2**attempt) + random.uniform(0, base)
+
+
+def execute_concurrent_async(
+    session: Session,
+    statements_and_params: Iterable[Tuple[Statement, Optional[Sequence]]],
+    concurrency: int = 256,
+    max_attempts: int = 20,
+    on_progress: Optional[Callable[[int], None]] = None,
+) -> None:
+    """Execute statements asynchronously.
+
+    Keeps at most `concurrency` requests in flight. Requests failing with
+    a retryable error are re-submitted with exponential backoff, up to
+    `max_attempts` attempts; other errors are raised immediately.
+    `on_progress` is called with the number of rows written whenever a
+    request has completed.
+    """
+    inflight: Deque[Tuple[ResponseFuture, Statement, Optional[Sequence]]] = deque()
+
+    def wait_for_oldest() -> None:
+        future, stmt, params = inflight.popleft()
+        attempt = 1
+        while True:
+            try:
+                future.result()
+                if on_progress is not None:
+                    on_progress(len(stmt) if isinstance(stmt, BatchStatement) else 1)
+                return
+            except RETRYABLE_ERRORS as exception:
+                if attempt >= max_attempts:
+                    raise
+                delay = backoff_delay(attempt)
+                print(f"{exception!r}, retrying in {delay:.1f}s")
+                time.sleep(delay)
+                attempt += 1
+                future = session.execute_async(stmt, params)
+
+    for stmt, params in statements_and_params:
+        if len(inflight) >= concurrency:
+            wait_for_oldest()
+        inflight.append((session.execute_async(stmt, params), stmt, params))
+
+    while inflight:
+        wait_for_oldest()
+
+
 def cassandra_ingest(
     session: Session,
     prepared_stmt: PreparedStatement,
-    parameters,
-    concurrency: int = 100,
-    retry_thsh: int = 1000,
+    parameters: Iterable,
+    concurrency: int = 256,
+    max_attempts: int = 20,
+    on_progress: Optional[Callable[[int], None]] = None,
 ) -> None:
     """Concurrent ingest into Apache Cassandra."""
-    ctr = 0
-    while True:
-        try:
-            results = execute_concurrent_with_args(
-                session=session,
-                statement=prepared_stmt,
-                parameters=parameters,
-                concurrency=concurrency,
-            )
 
-            for (i, (success, _)) in enumerate(results):
-                if not success:
-                    while True:
-                        try:
-                            session.execute(prepared_stmt, parameters[i])
-                        except Exception as exception:
-                            ctr += 1
-                            if ctr > retry_thsh:
-                                raise exception
-                            print(exception)
-                            continue
-                        ctr = 0
-                        break
-            break
+    execute_concurrent_async(
+        session,
+        ((prepared_stmt, params) for params in parameters),
+        concurrency,
+        max_attempts,
+        on_progress,
+    )
 
-        except Exception as exception:
-            ctr += 1
-            if ctr > retry_thsh:
-                raise exception
-            print(exception)
-            time.sleep(1)
-            continue
-        ctr = 0
+
+def partition_batches(
+    prepared_stmt: PreparedStatement, parameters: Iterable, max_batch_size: int
+) -> Iterator[Tuple[Statement, Optional[Sequence]]]:
+    """Yield unlogged batches of at most `max_batch_size` rows sharing
+    the same partition key (first column). Single rows are yielded as
+    plain inserts."""
+
+    rows = sorted(parameters, key=itemgetter(0))
+    for _, group in groupby(rows, key=itemgetter(0)):
+        group = list(group)
+        for i in range(0, len(group), max_batch_size):
+            chunk = group[i : i + max_batch_size]
+            if len(chunk) == 1:
+                yield prepared_stmt, chunk[0]
+                continue
+            batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+            for row in chunk:
+                batch.add(prepared_stmt, row)
+            yield batch, None
+
+
+def cassandra_ingest_partitioned(
+    session: Session,
+    prepared_stmt: PreparedStatement,
+    parameters: Iterable,
+    concurrency: int = 256,
+    max_batch_size: int = 100,
+    max_attempts: int = 20,
+    on_progress: Optional[Callable[[int], None]] = None,
+) -> None:
+    """Concurrent ingest into Apache Cassandra using unlogged batches.
+
+    Rows are grouped by their partition key (first column) and each
+    group is written with unlogged batches of at most `max_batch_size`
+    rows, so every batch targets a single partition. Batches are bound
+    lazily, only about `concurrency` of them are alive at a time.
+    """
+
+    execute_concurrent_async(
+        session,
+        partition_batches(prepared_stmt, parameters, max_batch_size),
+        concurrency,
+        max_attempts,
+        on_progress,
+    )
 
 
 def ingest_configuration(
@@ -311,160 +729,120 @@ def ingest_configuration(
 ) -> None:
     """Store configuration details in Cassandra table."""
 
-    cql_str = """INSERT INTO configuration
-                 (id, block_bucket_size, tx_prefix_length)
-                 VALUES (%s, %s, %s)"""
-    session.execute(
-        cql_str,
-        (keyspace, int(block_bucket_size), int(tx_hash_prefix_len)),
+    prepared_stmt = get_prepared_statement(
+        session, "configuration", ("id", "block_bucket_size", "tx_prefix_length")
     )
+    session.execute(prepared_stmt, (keyspace, block_bucket_size, tx_hash_prefix_len))
 
 
-def ingest_logs(
-    items: Iterable,
-    session: Session,
-    prepared_stmt: PreparedStatement,
-    block_bucket_size: int = 1_000,
-) -> None:
-    """Ingest blocks into Apache Cassandra."""
+def receipt_to_columns(item: Dict) -> Tuple[str, Dict]:
+    """Convert exported receipt to its transaction hash and the receipt
+    columns of the transaction table."""
 
-    blob_colums = [
-        "block_hash",
-        "address",
-        "data",
-        "topic0",
-        "tx_hash",
-    ]
-    for item in items:
-        # remove column
-        item.pop("type")
-        # rename/add columns
-        item["tx_hash"] = item.pop("transaction_hash")
-        item["block_id"] = item.pop("block_number")
-        item["block_id_group"] = item["block_id"] // block_bucket_size
+    return item["transaction_hash"], {
+        "receipt_cumulative_gas_used": item["cumulative_gas_used"],
+        "receipt_gas_used": item["gas_used"],
+        "receipt_contract_address": item["contract_address"],
+        "receipt_root": item["root"],
+        "receipt_status": item["status"],
+        "receipt_effective_gas_price": item["effective_gas_price"],
+    }
 
-        tpcs = item["topics"]
 
-        if tpcs is None:
-            tpcs = []
+def compile_row_converter(
+    fields: Sequence[Tuple[str, str, str]], name: str = "to_row", **constants
+) -> Callable[[Dict], Tuple]:
+    """Compile a function converting an exported item to a table row.
 
-        if "topic0" not in item:
-            # bugfix do not use None for topic0 but 0x, None
-            # gets converted to UNSET which is not allowed for
-            # key columns in cassandra and can not be filtered
-            item["topic0"] = tpcs[0] if len(tpcs) > 0 else "0x"
+    Each field is a (column, kind, source) triple. Kind "value" takes
+    item[source] as is, "blob" decodes the hex string item[source] and
+    "expr" evaluates the Python expression source, which may refer to
+    item, hex_to_bytes and the given constants. None values are replaced
+    by UNSET_VALUE (see
+    https://stackoverflow.com/questions/34637680/how-insert-in-cassandra-without-null-value-in-column).
 
-        item["topics"] = [hex_to_bytearray(t) for t in tpcs]
+    The source of the function is generated once, so converting an item
+    does not loop over the fields or call helpers per column.
+    """
 
-        if "transaction_hash" in item:
-            item.pop("transaction_hash")
+    lines = [f"def {name}(item):"]
+    for i, (column, kind, source) in enumerate(fields):
+        if kind == "value":
+            value, converted = f"item[{source!r}]", "v"
+        elif kind == "blob":
+            value, converted = f"item[{source!r}]", "unhexlify(v[2:])"
+        elif kind == "expr":
+            value, converted = source, "v"
+        else:
+            raise ValueError(f"Unknown kind '{kind}' of column {column}")
+        lines.append(f"    v = {value}")
+        lines.append(f"    c{i} = UNSET_VALUE if v is None else {converted}")
+    lines.append(f"    return ({''.join(f'c{i}, ' for i in range(len(fields)))})")
+
+    namespace = {
+        "UNSET_VALUE": UNSET_VALUE,
+        "unhexlify": unhexlify,
+        "hex_to_bytes": hex_to_bytes,
+        **constants,
+    }
+    exec(compile("\n".join(lines), f"<{name}>", "exec"), namespace)
+    return namespace[name]
 
-        for elem in blob_colums:
-            item[elem] = hex_to_bytearray(item[elem])
 
-    items = [none_to_unset(row) for row in items]
+def ingest_logs(
+    rows: Iterable,
+    session: Session,
+    prepared_stmt: PreparedStatement,
+    concurrency: int = 256,
+    on_progress: Optional[Callable[[int], None]] = None,
+) -> None:
+    """Ingest log rows into Apache Cassandra."""
 
-    cassandra_ingest(session, prepared_stmt, items)
+    cassandra_ingest_partitioned(
+        session, prepared_stmt, rows, concurrency, on_progress=on_progress
+    )
 
 
 def ingest_blocks(
-    items: Iterable,
+    rows: Iterable,
     session: Session,
     prepared_stmt: PreparedStatement,
-    block_bucket_size: int = 1_000,
+    concurrency: int = 256,
+    on_progress: Optional[Callable[[int], None]] = None,
 ) -> None:
-    """Ingest blocks into Apache Cassandra."""
-
-    blob_colums = [
-        "block_hash",
-        "parent_hash",
-        "nonce",
-        "sha3_uncles",
-        "logs_bloom",
-        "transactions_root",
-        "state_root",
-        "receipts_root",
-        "miner",
-        "extra_data",
-    ]
-    for item in items:
-        # remove column
-        item.pop("type")
-        # rename/add columns
-        item["block_id"] = item.pop("number")
-        item["block_id_group"] = item["block_id"] // block_bucket_size
-        item["block_hash"] = item.pop("hash")
-        # convert hex strings to byte arrays (blob in Cassandra)
-        for elem in blob_colums:
-            item[elem] = hex_to_bytearray(item[elem])
-
-    items = [none_to_unset(row) for row in items]
-
-    cassandra_ingest(session, prepared_stmt, items)
+    """Ingest block rows into Apache Cassandra."""
+
+    cassandra_ingest_partitioned(
+        session, prepared_stmt, rows, concurrency, on_progress=on_progress
+    )
 
 
 def ingest_transactions(
-    items: Iterable,
+    rows: Iterable,
     session: Session,
     prepared_stmt: PreparedStatement,
-    tx_hash_prefix_len: int = 4,
+    concurrency: int = 256,
+    on_progress: Optional[Callable[[int], None]] = None,
 ) -> None:
-    """Ingest transactions into Apache Cassandra."""
-
-    blob_colums = [
-        "tx_hash",
-        "from_address",
-        "to_address",
-        "input",
-        "block_hash",
-        "receipt_contract_address",
-        "receipt_root",
-    ]
-    for item in items:
-        # remove column
-        item.pop("type")
-        # rename/add columns
-        item["tx_hash"] = item.pop("hash")
-        hash_slice = slice(2, 2 + tx_hash_prefix_len)
-        item["tx_hash_prefix"] = item["tx_hash"][hash_slice]
-        item["block_id"] = item.pop("block_number")
-        # convert hex strings to byte arrays (blob in Cassandra)
-        for elem in blob_colums:
-            item[elem] = hex_to_bytearray(item[elem])
-
-    items = [none_to_unset(row) for row in items]
-
-    cassandra_ingest(session, prepared_stmt, items)
+    """Ingest transaction rows into Apache Cassandra."""
+
+    cassandra_ingest(
+        session, prepared_stmt, rows, concurrency, on_progress=on_progress
+    )
 
 
 def ingest_traces(
-    items: Iterable,
+    rows: Iterable,
     session: Session,
     prepared_stmt: PreparedStatement,
-    block_bucket_size: int = 1_000,
+    concurrency: int = 256,
+    on_progress: Optional[Callable[[int], None]] = None,
 ) -> None:
-    """Ingest traces into Apache Cassandra."""
-
-    blob_colums = ["tx_hash", "from_address", "to_address", "input", "output"]
-    for item in items:
-        # remove column
-        item.pop("type")
-        # rename/add columns
-        item["tx_hash"] = item.pop("transaction_hash")
-        item["block_id"] = item.pop("block_number")
-        item["block_id_group"] = item["block_id"] // block_bucket_size
-        item["trace_address"] = (
-            ",".join(map(str, item["trace_address"]))
-            if item["trace_address"] is not None
-            else None
-        )
-        # convert hex strings to byte arrays (blob in Cassandra)
-        for elem in blob_colums:
-            item[elem] = hex_to_bytearray(item[elem])
+    """Ingest trace rows into Apache Cassandra."""
 
-    items = [none_to_unset(row) for row in items]
-
-    cassandra_ingest(session, prepared_stmt, items)
+    cassandra_ingest_partitioned(
+        session, prepared_stmt, rows, concurrency, on_progress=on_progress
+    )
 
 
 def create_parser() -> ArgumentParser:
@@ -480,7 +858,32 @@ def create_parser() -> ArgumentParser:
         dest="batch_size",
         type=int,
         default=10,
-        help="number of blocks to export at a time (default: 10)",
+        help="min. number of blocks to export at a time (default: 10)",
+    )
+    parser.add_argument(
+        "--max-batch-size",
+        dest="max_batch_size",
+        type=int,
+        default=200,
+        help="max. number of blocks to export at a time; the batch size "
+        "grows up to this value while the export is slower than the ingest "
+        "(default: 200)",
+    )
+    parser.add_argument(
+        "--max-workers",
+        dest="max_workers",
+        type=int,
+        default=16,
+        help="number of parallel JSON-RPC batch requests per export job "
+        "(default: 16)",
+    )
+    parser.add_argument(
+        "--rpc-concurrency",
+        dest="rpc_concurrency",
+        type=int,
+        default=None,
+        help="maximum number of JSON-RPC requests in flight, e.g. to stay "
+        "within rate limits of remote providers (default: no limit)",
     )
     parser.add_argument(
         "-d",
@@ -513,6 +916,21 @@ def create_parser() -> ArgumentParser:
         "since currency exchange rates might not be "
         "available for the current day",
     )
+    parser.add_argument(
+        "--rpc-batch-size",
+        dest="rpc_batch_size",
+        type=int,
+        default=190,
+        help="max. number of requests per JSON-RPC batch, reduced "
+        "automatically if rejected by the client (default: 190)",
+    )
+    parser.add_argument(
+        "--write-concurrency",
+        dest="write_concurrency",
+        type=int,
+        default=256,
+        help="max. number of concurrent Cassandra write requests (default: 256)",
+    )
     parser.add_argument(
         "-w",
         "--web3-provider-uri",
@@ -566,24 +984,57 @@ def main() -> None:
 
     args = create_parser().parse_args()
 
+    rpc_slots = None
+    if args.rpc_concurrency is not None:
+        rpc_slots = threading.BoundedSemaphore(args.rpc_concurrency)
     thread_proxy = ThreadLocalProxy(
-        lambda: get_provider_from_uri(
-            args.provider_uri, timeout=args.timeout, batch=True
-        )
+        lambda: get_batch_provider(args.provider_uri, args.timeout, rpc_slots)
     )
+    web3 = Web3(thread_proxy)
 
-    cluster = Cluster(args.db_nodes)
+    # route each write directly to a replica owning its partition; allow
+    # slow (large batch) writes instead of timing out and retrying them
+    profile = ExecutionProfile(
+        load_balancing_policy=TokenAwarePolicy(DCAwareRoundRobinPolicy()),
+        request_timeout=DEFAULT_TIMEOUT,
+    )
+    cluster = Cluster(
+        args.db_nodes, execution_profiles={EXEC_PROFILE_DEFAULT: profile}
+    )
     session = cluster.connect(args.keyspace)
 
-    last_synced_block = get_last_synced_block(thread_proxy)
-    last_ingested_block = get_last_ingested_block(session)
+    last_synced_block = get_last_synced_block(web3)
+    last_ingested_block = get_last_ingested_block(session, head=last_synced_block)
     print_block_info(last_synced_block, last_ingested_block)
 
     if args.info:
         cluster.shutdown()
         raise SystemExit(0)
 
-    adapter = EthStreamerAdapter(thread_proxy, batch_size=50)
+    rpc_batch_size = probe_rpc_batch_size(thread_proxy, args.rpc_batch_size)
+    print(f"JSON-RPC batch size: {rpc_batch_size}")
+
+    adapter = EthStreamerAdapter(
+        thread_proxy,
+        batch_size=min(50, rpc_batch_size),
+        max_workers=args.max_workers,
+        receipts_batch_size=rpc_batch_size,
+        converters={
+            "block": compile_row_converter(
+                BLOCK_FIELDS, "block_to_row", block_bucket_size=BLOCK_BUCKET_SIZE
+            ),
+            "receipt": receipt_to_columns,
+            "log": compile_row_converter(
+                LOG_FIELDS, "log_to_row", block_bucket_size=BLOCK_BUCKET_SIZE
+            ),
+            "trace": compile_row_converter(
+                TRACE_FIELDS, "trace_to_row", block_bucket_size=BLOCK_BUCKET_SIZE
+            ),
+        },
+    )
+    transaction_to_row = compile_row_converter(
+        TX_FIELDS, "transaction_to_row", tx_hash_prefix_len=TX_HASH_PREFIX_LEN
+    )
 
     start_block = 0
     if args.start_block is None:
@@ -596,64 +1047,145 @@ def main() -> None:
     if args.end_block is not None:
         end_block = args.end_block
     if args.prev_day:
-        end_block = get_last_block_yesterday(thread_proxy)
+        end_block = get_last_block_yesterday(web3)
 
     if start_block > end_block:
         print("No blocks to ingest")
         raise SystemExit(0)
 
-    time1 = datetime.now()
+    last_report = time.monotonic()
     count = 0
+    writes = 0
+    writes_lock = threading.Lock()
+
+    def count_writes(num_rows: int) -> None:
+        nonlocal writes
+        with writes_lock:
+            writes += num_rows
 
     print(
-        f"[{time1}] Ingesting block range "
+        f"[{datetime.now()}] Ingesting block range "
         f"{start_block:,}:{end_block:,} "
         f"into Cassandra nodes {args.db_nodes}"
     )
 
     prep_stmt = {
-        elem: get_prepared_statement(session, args.keyspace, elem)
-        for elem in ["trace", "transaction", "block", "log"]
+        table: get_prepared_statement(session, table, tuple(c for c, _, _ in fields))
+        for table, fields in [
+            ("trace", TRACE_FIELDS),
+            ("transaction", TX_FIELDS),
+            ("block", BLOCK_FIELDS),
+            ("log", LOG_FIELDS),
+        ]
     }
 
-    for block_id in range(start_block, end_block + 1, args.batch_size):
-        current_end_block = min(end_block, block_id + args.batch_size - 1)
-
-        blocks, txs = adapter.export_blocks_and_transactions(
-            block_id, current_end_block
+    checkpoint = has_checkpoint_table(session)
+    if not checkpoint:
+        print(
+            f"No {CHECKPOINT_TABLE} table in keyspace {args.keyspace}, "
+            "last ingested block is determined from the block table"
         )
-        receipts, logs = adapter.export_receipts_and_logs(txs)
-        traces = adapter.export_traces(block_id, current_end_block, True, True)
 
-        enriched_txs = enrich_transactions(txs, receipts)
+    tuner = BatchSizeTuner(args.batch_size, args.max_batch_size)
+    executor = ThreadPoolExecutor(max_workers=1)
+    trace_executor = ThreadPoolExecutor(max_workers=1)
+    ingest_executor = ThreadPoolExecutor(max_workers=3)
+    # export the next block range from the client while the current one
+    # is ingested into Cassandra
+    block_id = start_block
+    current_end_block = min(end_block, block_id + tuner.batch_size - 1)
+    export_future = executor.submit(
+        timed,
+        export_block_range,
+        adapter,
+        block_id,
+        current_end_block,
+        transaction_to_row,
+        trace_executor,
+    )
+
+    while block_id <= end_block:
+        (blocks, txs, logs, traces), export_time = export_future.result()
+
+        next_block_id = current_end_block + 1
+        next_end_block = min(end_block, next_block_id + tuner.batch_size - 1)
+        if next_block_id <= end_block:
+            export_future = executor.submit(
+                timed,
+                export_block_range,
+                adapter,
+                next_block_id,
+                next_end_block,
+                transaction_to_row,
+                trace_executor,
+            )
 
-        # ingest into Cassandra
-        ingest_logs(logs, session, prep_stmt["log"], BLOCK_BUCKET_SIZE)
-        ingest_traces(traces, session, prep_stmt["trace"], BLOCK_BUCKET_SIZE)
-        ingest_transactions(
-            enriched_txs, session, prep_stmt["transaction"], TX_HASH_PREFIX_LEN
+        ingest_start = time.perf_counter()
+
+        # ingest into Cassandra, logs, traces and transactions in
+        # parallel; blocks last since the block table marks where to
+        # resume
+        ingest_futures = [
+            ingest_executor.submit(
+                ingest,
+                rows,
+                session,
+                prep_stmt[table],
+                args.write_concurrency,
+                on_progress=count_writes,
+            )
+            for ingest, rows, table in [
+                (ingest_logs, logs, "log"),
+                (ingest_traces, traces, "trace"),
+                (ingest_transactions, txs, "transaction"),
+            ]
+        ]
+        for future in ingest_futures:
+            future.result()
+        ingest_blocks(
+            blocks,
+            session,
+            prep_stmt["block"],
+            args.write_concurrency,
+            on_progress=count_writes,
         )
-        ingest_blocks(blocks, session, prep_stmt["block"], BLOCK_BUCKET_SIZE)
+        # release the rows of this range while the next one is exported,
+        # not only when its result replaces them
+        del blocks, txs, logs, traces
+
+        if checkpoint:
+            last_ingested_block = max(last_ingested_block or 0, current_end_block)
+            store_checkpoint(session, last_ingested_block)
 
-        count += args.batch_size
+        ingest_time = time.perf_counter() - ingest_start
+        num_blocks = current_end_block - block_id + 1
+        tuner.update(num_blocks, export_time, ingest_time)
 
-        if count % 1000 == 0:
-            time2 = datetime.now()
-            time_delta = (time2 - time1).total_seconds()
+        count += num_blocks
+
+        now = time.monotonic()
+        if now - last_report >= PROGRESS_INTERVAL:
+            time_delta = now - last_report
             print(
-                f"[{time2}] "
+                f"[{datetime.now()}] "
                 f"Last processed block: {current_end_block:,} "
-                f"({count/time_delta:.1f} blocks/s)"
+                f"({count/time_delta:.1f} blocks/s, "
+                f"{writes/time_delta:.1f} rows/s)"
             )
-            time1 = time2
+            last_report = now
             count = 0
+            writes = 0
+
+        block_id, current_end_block = next_block_id, next_end_block
+
+    executor.shutdown()
+    trace_executor.shutdown()
+    ingest_executor.shutdown()
 
     print(f"[{datetime.now()}] Processed block range " f"{start_block:,}:{end_block:,}")
 
     # store configuration details
-    ingest_configuration(
-        session, args.keyspace, int(BLOCK_BUCKET_SIZE), int(TX_HASH_PREFIX_LEN)
-    )
+    ingest_configuration(session, args.keyspace, BLOCK_BUCKET_SIZE, TX_HASH_PREFIX_LEN)
 
     cluster.shutdown()
 
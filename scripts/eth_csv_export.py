@@ -7,28 +7,36 @@ Exports blocks, transactions/receipts and traces to CSV files.
 
 import warnings
 from argparse import ArgumentParser
-from csv import DictWriter, QUOTE_NONE
+from concurrent.futures import Future, ThreadPoolExecutor
+from csv import QUOTE_NONE, writer
 from datetime import datetime, timedelta, timezone
 import gzip
+from operator import itemgetter
 import pathlib
 import re
-from typing import Dict, Iterable, List, Tuple
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
 
 from ethereumetl.jobs.export_blocks_job import ExportBlocksJob
 from ethereumetl.jobs.export_receipts_job import ExportReceiptsJob
 from ethereumetl.jobs.export_traces_job import ExportTracesJob
-from ethereumetl.providers.auto import get_provider_from_uri
 from ethereumetl.service.eth_service import EthService
-from ethereumetl.streaming.enrich import enrich_transactions
-from ethereumetl.streaming.eth_item_id_calculator import EthItemIdCalculator
-from ethereumetl.streaming.eth_item_timestamp_calculator import (
-    EthItemTimestampCalculator,
-)
 from ethereumetl.thread_local_proxy import ThreadLocalProxy
 from web3 import Web3
 
+from eth_rpc import (
+    ExportBlockReceiptsJob,
+    get_batch_provider,
+    supports_block_receipts,
+)
+
 
 TX_HASH_PREFIX_LEN = 5
+# zlib's default level; gzip.open defaults to 9, which is ~1.5x slower
+# for well under 1% smaller files on hex-heavy CSV
+GZIP_COMPRESSLEVEL = 6
+# block range end in file names, e.g. block_00000000-00000999.csv.gz
+LAST_BLOCK_PATTERN = re.compile(r".*-(\d+)")
 
 BLOCK_HEADER = [
     "parent_hash",
@@ -52,6 +60,12 @@ BLOCK_HEADER = [
     "block_id_group",
     "block_hash",
 ]
+# item keys of the header columns; ethereum-etl names some columns
+# differently, the items are written as exported instead of renaming keys
+BLOCK_KEYS = [
+    {"block_id": "number", "block_hash": "hash"}.get(column, column)
+    for column in BLOCK_HEADER
+]
 
 TX_HEADER = [
     "nonce",
@@ -77,6 +91,20 @@ TX_HEADER = [
     "tx_hash_prefix",
     "block_id",
 ]
+TX_KEYS = [
+    {"tx_hash": "hash", "block_id": "block_number"}.get(column, column)
+    for column in TX_HEADER
+]
+
+# receipt fields added to transactions as receipt_<field> columns
+RECEIPT_FIELDS = [
+    "cumulative_gas_used",
+    "gas_used",
+    "contract_address",
+    "root",
+    "status",
+    "effective_gas_price",
+]
 
 TRACE_HEADER = [
     "transaction_index",
@@ -100,6 +128,10 @@ TRACE_HEADER = [
     "block_id",
     "block_id_group",
 ]
+TRACE_KEYS = [
+    {"tx_hash": "transaction_hash", "block_id": "block_number"}.get(column, column)
+    for column in TRACE_HEADER
+]
 
 LOGS_HEADER = [
     "block_id_group",
@@ -113,6 +145,10 @@ LOGS_HEADER = [
     "log_index",
     "transaction_index",
 ]
+LOGS_KEYS = [
+    {"tx_hash": "transaction_hash", "block_id": "block_number"}.get(column, column)
+    for column in LOGS_HEADER
+]
 
 
 class InMemoryItemExporter:
@@ -121,18 +157,20 @@ class InMemoryItemExporter:
     def __init__(self, item_types: Iterable) -> None:
         self.item_types = item_types
         self.items: Dict[str, List] = {}
+        self.appenders: Dict[str, Callable] = {}
 
     def open(self) -> None:
         """Open item exporter."""
         for item_type in self.item_types:
             self.items[item_type] = []
+        # bound append methods, one dict lookup per exported item
+        self.appenders = {
+            item_type: items.append for item_type, items in self.items.items()
+        }
 
     def export_item(self, item) -> None:
         """Export single item."""
-        item_type = item.get("type", None)
-        if item_type is None:
-            raise ValueError(f"type key is not found in item {item}")
-        self.items[item_type].append(item)
+        self.appenders[item["type"]](item)
 
     def close(self) -> None:
         """Close item exporter."""
@@ -153,10 +191,13 @@ class EthStreamerAdapter:
         max_workers: int = 5,
     ) -> None:
         self.batch_web3_provider = batch_web3_provider
+        # one Web3 instance for all export jobs; the jobs' worker threads
+        # are short-lived, requests go through their thread-local provider
+        self.web3 = Web3(batch_web3_provider)
         self.batch_size = batch_size
         self.max_workers = max_workers
-        self.item_id_calculator = EthItemIdCalculator()
-        self.item_timestamp_calculator = EthItemTimestampCalculator()
+        # probed on first receipt export
+        self.block_receipts: Optional[bool] = None
 
     def export_blocks_and_transactions(
         self,
@@ -189,20 +230,40 @@ class EthStreamerAdapter:
     def export_receipts_and_logs(
         self, transactions: Iterable
     ) -> Tuple[Iterable, Iterable]:
-        """Export receipts and logs for specified transaction hashes."""
+        """Export receipts and logs for specified transactions.
 
+        Receipts are requested per block if the Ethereum client supports
+        eth_getBlockReceipts, otherwise per transaction hash.
+        """
+
+        block_numbers = sorted({tx["block_number"] for tx in transactions})
+        if self.block_receipts is None and block_numbers:
+            self.block_receipts = supports_block_receipts(
+                self.batch_web3_provider, block_numbers[0]
+            )
         exporter = InMemoryItemExporter(item_types=["receipt", "log"])
-        job = ExportReceiptsJob(
-            transaction_hashes_iterable=(
-                transaction["hash"] for transaction in transactions
-            ),
-            batch_size=self.batch_size,
-            batch_web3_provider=self.batch_web3_provider,
-            max_workers=self.max_workers,
-            item_exporter=exporter,
-            export_receipts=True,
-            export_logs=True,
-        )
+        if self.block_receipts:
+            job = ExportBlockReceiptsJob(
+                block_numbers_iterable=block_numbers,
+                batch_size=self.batch_size,
+                batch_web3_provider=self.batch_web3_provider,
+                max_workers=self.max_workers,
+                item_exporter=exporter,
+                export_receipts=True,
+                export_logs=True,
+            )
+        else:
+            job = ExportReceiptsJob(
+                transaction_hashes_iterable=(
+                    transaction["hash"] for transaction in transactions
+                ),
+                batch_size=self.batch_size,
+                batch_web3_provider=self.batch_web3_provider,
+                max_workers=self.max_workers,
+                item_exporter=exporter,
+                export_receipts=True,
+                export_logs=True,
+            )
 
         job.run()
         receipts = exporter.get_items("receipt")
@@ -223,7 +284,7 @@ class EthStreamerAdapter:
             start_block=start_block,
             end_block=end_block,
             batch_size=self.batch_size,
-            web3=ThreadLocalProxy(lambda: Web3(self.batch_web3_provider)),
+            web3=self.web3,
             max_workers=self.max_workers,
             item_exporter=exporter,
             include_genesis_traces=include_genesis_traces,
@@ -234,10 +295,9 @@ class EthStreamerAdapter:
         return traces
 
 
-def get_last_block_yesterday(batch_web3_provider: ThreadLocalProxy) -> int:
+def get_last_block_yesterday(web3: Web3) -> int:
     """Return last block number of previous day from Ethereum client."""
 
-    web3 = Web3(batch_web3_provider)
     eth_service = EthService(web3)
 
     date = datetime.utcnow().replace(
@@ -254,10 +314,24 @@ def get_last_block_yesterday(batch_web3_provider: ThreadLocalProxy) -> int:
     return end_block
 
 
-def get_last_synced_block(batch_web3_provider: ThreadLocalProxy) -> int:
+def get_last_synced_block(web3: Web3) -> int:
     """Return last synchronized block number from Ethereum client."""
 
-    return int(Web3(batch_web3_provider).eth.getBlock("latest").number)
+    return int(web3.eth.getBlock("latest").number)
+
+
+def add_receipts(transactions: List[Dict], receipts: Iterable[Dict]) -> List[Dict]:
+    """Add receipt columns to transactions, in place."""
+
+    receipts_by_hash = {receipt["transaction_hash"]: receipt for receipt in receipts}
+    columns = [f"receipt_{field}" for field in RECEIPT_FIELDS]
+    receipt_values = itemgetter(*RECEIPT_FIELDS)
+    for tx in transactions:
+        receipt = receipts_by_hash.get(tx["hash"])
+        if receipt is None:
+            raise ValueError(f"No receipt exported for transaction {tx['hash']}")
+        tx.update(zip(columns, receipt_values(receipt)))
+    return transactions
 
 
 def format_blocks(
@@ -267,12 +341,7 @@ def format_blocks(
     """Format blocks."""
 
     for item in items:
-        # remove column
-        item.pop("type")
-        # rename/add columns
-        item["block_id"] = item.pop("number")
-        item["block_id_group"] = item["block_id"] // block_bucket_size
-        item["block_hash"] = item.pop("hash")
+        item["block_id_group"] = item["number"] // block_bucket_size
 
     return items
 
@@ -283,14 +352,9 @@ def format_transactions(
 ) -> None:
     """Format transactions."""
 
+    hash_slice = slice(2, 2 + tx_hash_prefix_len)
     for item in items:
-        # remove column
-        item.pop("type")
-        # rename/add columns
-        item["tx_hash"] = item.pop("hash")
-        hash_slice = slice(2, 2 + tx_hash_prefix_len)
-        item["tx_hash_prefix"] = item["tx_hash"][hash_slice]
-        item["block_id"] = item.pop("block_number")
+        item["tx_hash_prefix"] = item["hash"][hash_slice]
 
     return items
 
@@ -302,12 +366,7 @@ def format_traces(
     """Format traces."""
 
     for item in items:
-        # remove column
-        item.pop("type")
-        # rename/add columns
-        item["tx_hash"] = item.pop("transaction_hash")
-        item["block_id"] = item.pop("block_number")
-        item["block_id_group"] = item["block_id"] // block_bucket_size
+        item["block_id_group"] = item["block_number"] // block_bucket_size
         item["trace_address"] = (
             "|".join(map(str, item["trace_address"]))
             if item["trace_address"] is not None
@@ -324,12 +383,7 @@ def format_logs(
     """Format logs."""
 
     for item in items:
-        # remove column
-        item.pop("type")
-        # rename/add columns
-        item["tx_hash"] = item.pop("transaction_hash")
-        item["block_id"] = item.pop("block_number")
-        item["block_id_group"] = item["block_id"] // block_bucket_size
+        item["block_id_group"] = item["block_number"] // block_bucket_size
 
         tpcs = item["topics"]
 
@@ -339,35 +393,83 @@ def format_logs(
         if "topic0" not in item:
             item["topic0"] = tpcs[0] if len(tpcs) > 0 else None
 
-        qt = ",".join([f'"{t}"' for t in tpcs])
-
-        item["topics"] = f"[{qt}]"
-
-        if "transaction_hash" in item:
-            item.pop("transaction_hash")
+        # ["topic0","topic1",...], joined in one call without quoting
+        # each topic separately
+        item["topics"] = '["' + '","'.join(tpcs) + '"]' if tpcs else "[]"
 
     return items
 
 
-def write_csv(
-    filename: str, data: Iterable, header: Iterable, delimiter: str = ",", quoting=None
-) -> None:
-    """Write list of dicts to compresses CSV file."""
+class CsvFile:
+    """Gzip-compressed CSV file, written in batches of dicts.
+
+    Rows go to <filename>.partial, which is renamed to filename on close,
+    so that incomplete files are neither imported nor taken as exported
+    when continuing an export.
+    """
 
-    with gzip.open(filename, "wt") as csv_file:
+    def __init__(
+        self,
+        filename: pathlib.Path,
+        header: Sequence,
+        keys: Optional[Sequence] = None,
+        delimiter: str = ",",
+        quoting=None,
+    ) -> None:
+        self.filename = filename
+        self.partial_filename = filename.with_name(filename.name + ".partial")
+        self.file = gzip.open(
+            self.partial_filename, "wt", compresslevel=GZIP_COMPRESSLEVEL
+        )
         if quoting is None:
-            csv_writer = DictWriter(csv_file, delimiter=delimiter, fieldnames=header)
+            self.writer = writer(self.file, delimiter=delimiter)
         else:
-            csv_writer = DictWriter(
-                csv_file,
-                delimiter=delimiter,
-                fieldnames=header,
-                quoting=quoting,
-                quotechar="",
+            self.writer = writer(
+                self.file, delimiter=delimiter, quoting=quoting, quotechar=""
             )
-        csv_writer.writeheader()
-        for row in data:
-            csv_writer.writerow(row)
+        self.writer.writerow(header)
+        # header columns are taken from these dict keys
+        self.row = itemgetter(*(keys or header))
+
+    def write(self, items: Iterable) -> None:
+        """Write dicts as CSV rows."""
+        self.writer.writerows(map(self.row, items))
+
+    def close(self) -> None:
+        """Close file and move it to its final name."""
+        self.file.close()
+        self.partial_filename.rename(self.filename)
+
+
+def open_csv_files(directory: pathlib.Path, block_range: Tuple) -> List[CsvFile]:
+    """Open block, transaction, trace and log CSV files of a block range."""
+
+    return [
+        CsvFile(
+            directory / ("block_%08d-%08d.csv.gz" % block_range),
+            BLOCK_HEADER,
+            BLOCK_KEYS,
+        ),
+        CsvFile(directory / ("tx_%08d-%08d.csv.gz" % block_range), TX_HEADER, TX_KEYS),
+        CsvFile(
+            directory / ("trace_%08d-%08d.csv.gz" % block_range),
+            TRACE_HEADER,
+            TRACE_KEYS,
+        ),
+        CsvFile(
+            directory / ("logs_%08d-%08d.csv.gz" % block_range),
+            LOGS_HEADER,
+            LOGS_KEYS,
+            delimiter="|",
+            quoting=QUOTE_NONE,
+        ),
+    ]
+
+
+def last_block_of_file(filename: pathlib.Path) -> int:
+    """Return last block number of the range in a CSV file name."""
+
+    return int(LAST_BLOCK_PATTERN.match(filename.name).group(1))
 
 
 def create_parser() -> ArgumentParser:
@@ -404,6 +506,14 @@ def create_parser() -> ArgumentParser:
         default=1000,
         help="number of blocks to export to a CSV file (default: 1000)",
     )
+    parser.add_argument(
+        "--max-workers",
+        dest="max_workers",
+        type=int,
+        default=16,
+        help="number of parallel JSON-RPC batch requests per export job "
+        "(default: 16)",
+    )
     parser.add_argument(
         "--partition-batch-size",
         dest="partition_batch_size",
@@ -411,6 +521,14 @@ def create_parser() -> ArgumentParser:
         default=1_000_000,
         help="number of blocks to export in partition (default: 1_000_000)",
     )
+    parser.add_argument(
+        "--rpc-concurrency",
+        dest="rpc_concurrency",
+        type=int,
+        default=None,
+        help="maximum number of JSON-RPC requests in flight, e.g. to stay "
+        "within rate limits of remote providers (default: no limit)",
+    )
     parser.add_argument(
         "-p",
         "--previous_day",
@@ -461,31 +579,35 @@ def main() -> None:
 
     args = create_parser().parse_args()
 
+    rpc_slots = None
+    if args.rpc_concurrency is not None:
+        rpc_slots = threading.BoundedSemaphore(args.rpc_concurrency)
     thread_proxy = ThreadLocalProxy(
-        lambda: get_provider_from_uri(
-            args.provider_uri, timeout=args.timeout, batch=True
-        )
+        lambda: get_batch_provider(args.provider_uri, args.timeout, rpc_slots)
     )
+    web3 = Web3(thread_proxy)
 
-    adapter = EthStreamerAdapter(thread_proxy, batch_size=50)
+    adapter = EthStreamerAdapter(
+        thread_proxy, batch_size=50, max_workers=args.max_workers
+    )
 
     start_block = 0
     if args.start_block is None:
         if args.continue_export:
-            block_files = sorted(pathlib.Path(args.dir).rglob("block*"))
-            if block_files:
-                last_file = block_files[-1].name
-                print(f"Last exported file: {block_files[-1]}")
-                start_block = int(re.match(r".*-(\d+)", last_file).group(1)) + 1
+            block_files = pathlib.Path(args.dir).rglob("block*.csv.gz")
+            last_file = max(block_files, key=last_block_of_file, default=None)
+            if last_file is not None:
+                print(f"Last exported file: {last_file}")
+                start_block = last_block_of_file(last_file) + 1
     else:
         start_block = args.start_block
 
-    end_block = get_last_synced_block(thread_proxy)
+    end_block = get_last_synced_block(web3)
     print(f"Last synced block: {end_block:,}")
     if args.end_block is not None:
         end_block = args.end_block
     if args.prev_day:
-        end_block = get_last_block_yesterday(thread_proxy)
+        end_block = get_last_block_yesterday(web3)
 
     time1 = datetime.now()
     count = 0
@@ -517,36 +639,53 @@ def main() -> None:
         print(exception)
         raise SystemExit(1) from exception
 
-    block_file = "block_%08d-%08d.csv.gz" % block_range
-    tx_file = "tx_%08d-%08d.csv.gz" % block_range
-    trace_file = "trace_%08d-%08d.csv.gz" % block_range
-    logs_file = "logs_%08d-%08d.csv.gz" % block_range
-
     print(
         f"[{time1}] Processing block range "
         f"{rounded_start_block:,}:{rounded_end_block:,}"
     )
 
-    block_list = []
-    tx_list = []
-    trace_list = []
-    logs_list = []
+    # rows are written in the background while the next block batch is
+    # exported, one file per thread
+    writer_pool = ThreadPoolExecutor(max_workers=4)
+    write_futures: List[Future] = []
+    # traces do not depend on blocks or receipts, export them concurrently
+    trace_executor = ThreadPoolExecutor(max_workers=1)
+    csv_files: Optional[List[CsvFile]] = None
 
     for block_id in range(rounded_start_block, rounded_end_block + 1, args.batch_size):
 
         current_end_block = min(end_block, block_id + args.batch_size - 1)
 
+        traces_future = trace_executor.submit(
+            adapter.export_traces, block_id, current_end_block, True, True
+        )
         blocks, txs = adapter.export_blocks_and_transactions(
             block_id, current_end_block
         )
         receipts, logs = adapter.export_receipts_and_logs(txs)
-        traces = adapter.export_traces(block_id, current_end_block, True, True)
-        enriched_txs = enrich_transactions(txs, receipts)
+        traces = traces_future.result()
+        enriched_txs = add_receipts(txs, receipts)
 
-        block_list.extend(format_blocks(blocks))
-        tx_list.extend(format_transactions(enriched_txs, TX_HASH_PREFIX_LEN))
-        trace_list.extend(format_traces(traces))
-        logs_list.extend(format_logs(logs))
+        if csv_files is None:
+            partition_start = block_id - (block_id % args.partition_batch_size)
+            partition_end = partition_start + args.partition_batch_size - 1
+            full_path = path / f"{partition_start:08d}-{partition_end:08d}"
+            full_path.mkdir(parents=True, exist_ok=True)
+            csv_files = open_csv_files(full_path, block_range)
+
+        rows = [
+            format_blocks(blocks),
+            format_transactions(enriched_txs, TX_HASH_PREFIX_LEN),
+            format_traces(traces),
+            format_logs(logs),
+        ]
+        # at most one batch is buffered: wait for the previous one first
+        for future in write_futures:
+            future.result()
+        write_futures = [
+            writer_pool.submit(csv_file.write, items)
+            for csv_file, items in zip(csv_files, rows)
+        ]
 
         count += args.batch_size
 
@@ -562,22 +701,12 @@ def main() -> None:
 
         if (block_id + args.batch_size) % block_bucket_size == 0:
             time3 = datetime.now()
-            partition_start = block_id - (block_id % args.partition_batch_size)
-            partition_end = partition_start + args.partition_batch_size - 1
-            sub_dir = f"{partition_start:08d}-{partition_end:08d}"
-            full_path = path / sub_dir
-            full_path.mkdir(parents=True, exist_ok=True)
-
-            write_csv(full_path / trace_file, trace_list, TRACE_HEADER)
-            write_csv(full_path / tx_file, tx_list, TX_HEADER)
-            write_csv(full_path / block_file, block_list, BLOCK_HEADER)
-            write_csv(
-                full_path / logs_file,
-                logs_list,
-                LOGS_HEADER,
-                delimiter="|",
-                quoting=QUOTE_NONE,
-            )
+            for future in write_futures:
+                future.result()
+            write_futures = []
+            for csv_file in csv_files:
+                csv_file.close()
+            csv_files = None
 
             print(
                 f"[{time3}] " f"Exported blocks: {block_range[0]:,}:{block_range[1]:,} "
@@ -587,15 +716,11 @@ def main() -> None:
                 block_id + args.batch_size,
                 block_id + args.batch_size + block_bucket_size - 1,
             )
-            block_file = "block_%08d-%08d.csv.gz" % block_range
-            tx_file = "tx_%08d-%08d.csv.gz" % block_range
-            trace_file = "trace_%08d-%08d.csv.gz" % block_range
-            logs_file = "logs_%08d-%08d.csv.gz" % block_range
-
-            block_list.clear()
-            tx_list.clear()
-            trace_list.clear()
-            logs_list.clear()
+
+    for future in write_futures:
+        future.result()
+    writer_pool.shutdown()
+    trace_executor.shutdown()
 
     print(
         f"[{datetime.now()}] Processed block range "
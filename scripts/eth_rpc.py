@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""JSON-RPC helpers shared by the ethereum-etl export scripts."""
+
+import json
+import threading
+from typing import Any, Iterable, Optional, Union
+from urllib.parse import urlparse
+
+from ethereumetl.jobs.export_receipts_job import ExportReceiptsJob
+from ethereumetl.json_rpc_requests import generate_json_rpc
+from ethereumetl.providers.auto import get_provider_from_uri
+from ethereumetl.providers.ipc import BatchIPCProvider
+from ethereumetl.providers.rpc import BatchHTTPProvider
+from ethereumetl.thread_local_proxy import ThreadLocalProxy
+from ethereumetl.utils import rpc_response_batch_to_results
+
+
+class ExportBlockReceiptsJob(ExportReceiptsJob):
+    """Export receipts and logs of whole blocks, using a single
+    eth_getBlockReceipts request per block instead of one
+    eth_getTransactionReceipt request per transaction."""
+
+    def __init__(self, block_numbers_iterable: Iterable[int], **kwargs) -> None:
+        super().__init__(transaction_hashes_iterable=block_numbers_iterable, **kwargs)
+
+    def _export_receipts(self, block_numbers):
+        receipts_rpc = [
+            generate_json_rpc(
+                method="eth_getBlockReceipts", params=[hex(number)], request_id=i
+            )
+            for i, number in enumerate(block_numbers)
+        ]
+        response = self.batch_web3_provider.make_batch_request(json.dumps(receipts_rpc))
+        # map the whole batch before exporting: an error result raises, and
+        # the batch is retried block by block, which must not export the
+        # receipts of blocks preceding the error twice
+        receipts = [
+            self.receipt_mapper.json_dict_to_receipt(result)
+            for results in rpc_response_batch_to_results(response)
+            for result in results
+        ]
+        for receipt in receipts:
+            self._export_receipt(receipt)
+
+
+def supports_block_receipts(
+    batch_web3_provider: ThreadLocalProxy, block_number: int
+) -> bool:
+    """Check whether the Ethereum client implements eth_getBlockReceipts."""
+
+    rpc = [
+        generate_json_rpc(
+            method="eth_getBlockReceipts", params=[hex(block_number)], request_id=0
+        )
+    ]
+    try:
+        response = batch_web3_provider.make_batch_request(json.dumps(rpc))
+        return isinstance(response[0].get("result"), list)
+    except Exception as exception:
+        print(f"eth_getBlockReceipts not available: {exception}")
+        return False
+
+
+class ThrottledRequestsMixin:
+    """Provider mixin holding one of the shared rpc_slots while a JSON-RPC
+    request is in flight.
+
+    Throttling happens in make_request itself, so that it also applies to
+    requests sent by Web3, whose middleware chain ends in make_request.
+    """
+
+    rpc_slots: threading.BoundedSemaphore
+
+    def make_request(self, method: str, params: Any) -> Any:
+        """Send JSON-RPC request once a slot is free."""
+        with self.rpc_slots:
+            return super().make_request(method, params)
+
+    def make_batch_request(self, text: str) -> Any:
+        """Send JSON-RPC batch request once a slot is free."""
+        with self.rpc_slots:
+            return super().make_batch_request(text)
+
+
+class ThrottledBatchHTTPProvider(ThrottledRequestsMixin, BatchHTTPProvider):
+    """Batch HTTP provider sharing a limit of requests in flight."""
+
+    def __init__(self, rpc_slots: threading.BoundedSemaphore, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.rpc_slots = rpc_slots
+
+
+class ThrottledBatchIPCProvider(ThrottledRequestsMixin, BatchIPCProvider):
+    """Batch IPC provider sharing a limit of requests in flight."""
+
+    def __init__(self, rpc_slots: threading.BoundedSemaphore, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.rpc_slots = rpc_slots
+
+
+def get_batch_provider(
+    provider_uri: str,
+    timeout: int,
+    rpc_slots: Optional[threading.BoundedSemaphore] = None,
+) -> Union[BatchHTTPProvider, BatchIPCProvider]:
+    """Return batch provider for an HTTP(S) or IPC (file://) URI.
+
+    Providers given the same rpc_slots semaphore together keep at most
+    as many requests in flight as the semaphore allows.
+    """
+
+    if rpc_slots is None:
+        return get_provider_from_uri(provider_uri, timeout=timeout, batch=True)
+    uri = urlparse(provider_uri)
+    if uri.scheme in ("http", "https"):
+        return ThrottledBatchHTTPProvider(
+            rpc_slots, provider_uri, request_kwargs={"timeout": timeout}
+        )
+    if uri.scheme == "file":
+        return ThrottledBatchIPCProvider(rpc_slots, uri.path, timeout=timeout)
+    raise ValueError(f"Unknown uri scheme {provider_uri}")
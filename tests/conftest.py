@@ -0,0 +1,5 @@
+import pathlib
+import sys
+
+# the scripts are installed as plain files, not as a package
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1] / "scripts"))
@@ -0,0 +1,33 @@
+from cassandra.query import SimpleStatement
+
+from eth_cassandra_streaming import cassandra_ingest_partitioned
+
+
+class DoneFuture:
+    def result(self):
+        return None
+
+
+class RecordingSession:
+    def __init__(self):
+        self.statements = []
+
+    def execute_async(self, stmt, params):
+        self.statements.append(stmt)
+        return DoneFuture()
+
+
+def test_progress_counts_rows_of_batches():
+    session = RecordingSession()
+    stmt = SimpleStatement("INSERT INTO t (k, v) VALUES (%s, %s)")
+    # 250 rows in partition 0 (batches of 100, 100 and 50) and a
+    # single row in partition 1
+    rows = [(0, i) for i in range(250)] + [(1, 0)]
+    progress = []
+
+    cassandra_ingest_partitioned(
+        session, stmt, rows, concurrency=2, on_progress=progress.append
+    )
+
+    assert len(session.statements) == 4
+    assert sorted(progress) == [1, 50, 100, 100]
@@ -0,0 +1,209 @@
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+
+from ethereumetl.thread_local_proxy import ThreadLocalProxy
+from web3 import Web3
+
+from eth_rpc import ExportBlockReceiptsJob, get_batch_provider
+
+
+class InMemoryExporter:
+    def __init__(self):
+        self.items = []
+
+    def open(self):
+        pass
+
+    def export_item(self, item):
+        self.items.append(item)
+
+    def close(self):
+        pass
+
+
+def receipt_json(block_number, index):
+    return {
+        "transactionHash": f"0x{block_number:04x}{index:04x}",
+        "transactionIndex": hex(index),
+        "blockHash": f"0x{block_number:064x}",
+        "blockNumber": hex(block_number),
+        "cumulativeGasUsed": "0x5208",
+        "gasUsed": "0x5208",
+        "contractAddress": None,
+        "status": "0x1",
+        "effectiveGasPrice": "0x1",
+        "logs": [
+            {
+                "logIndex": hex(index),
+                "transactionHash": f"0x{block_number:04x}{index:04x}",
+                "transactionIndex": hex(index),
+                "blockHash": f"0x{block_number:064x}",
+                "blockNumber": hex(block_number),
+                "address": "0x" + "11" * 20,
+                "data": "0x",
+                "topics": ["0x" + "22" * 32],
+            }
+        ],
+    }
+
+
+class FlakyBlockReceiptsProvider:
+    """Answers eth_getBlockReceipts, failing the first request for one block
+    with an error in the last item of the batch response."""
+
+    def __init__(self, failing_block):
+        self.failing_block = failing_block
+        self.failed = False
+
+    def make_batch_request(self, text):
+        response = []
+        for request in json.loads(text):
+            block_number = int(request["params"][0], 16)
+            if block_number == self.failing_block and not self.failed:
+                self.failed = True
+                response.append(
+                    {
+                        "jsonrpc": "2.0",
+                        "id": request["id"],
+                        "error": {"code": -32000, "message": "header not found"},
+                    }
+                )
+            else:
+                response.append(
+                    {
+                        "jsonrpc": "2.0",
+                        "id": request["id"],
+                        "result": [receipt_json(block_number, i) for i in range(2)],
+                    }
+                )
+        return response
+
+
+def test_block_receipts_exported_once_when_batch_is_retried():
+    exporter = InMemoryExporter()
+    provider = FlakyBlockReceiptsProvider(failing_block=12)
+    job = ExportBlockReceiptsJob(
+        block_numbers_iterable=[10, 11, 12],
+        batch_size=3,
+        batch_web3_provider=provider,
+        max_workers=1,
+        item_exporter=exporter,
+    )
+    job.run()
+
+    assert provider.failed
+    receipts = [item for item in exporter.items if item["type"] == "receipt"]
+    logs = [item for item in exporter.items if item["type"] == "log"]
+    receipt_hashes = [receipt["transaction_hash"] for receipt in receipts]
+    assert len(receipt_hashes) == 6
+    assert len(set(receipt_hashes)) == 6
+    assert len({(log["transaction_hash"], log["log_index"]) for log in logs}) == 6
+    assert len(logs) == 6
+
+
+class SlowJsonRpcServer(ThreadingHTTPServer):
+    """JSON-RPC server answering every request with an empty result after a
+    short delay, recording the largest number of requests in flight."""
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), SlowJsonRpcHandler)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+
+class SlowJsonRpcHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with self.server.lock:
+            self.server.in_flight += 1
+            self.server.max_in_flight = max(
+                self.server.max_in_flight, self.server.in_flight
+            )
+        time.sleep(0.05)
+        with self.server.lock:
+            self.server.in_flight -= 1
+        if isinstance(request, list):
+            response = [
+                {"jsonrpc": "2.0", "id": item["id"], "result": []} for item in request
+            ]
+        else:
+            response = {"jsonrpc": "2.0", "id": request["id"], "result": []}
+        body = json.dumps(response).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@contextmanager
+def slow_json_rpc_server():
+    server = SlowJsonRpcServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def run_concurrently(func, num_threads):
+    errors = []
+
+    def run(i):
+        try:
+            func(i)
+        except Exception as exception:
+            errors.append(exception)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+
+
+def test_rpc_slots_limit_web3_trace_requests():
+    with slow_json_rpc_server() as server:
+        uri = f"http://127.0.0.1:{server.server_address[1]}"
+        rpc_slots = threading.BoundedSemaphore(2)
+        provider = ThreadLocalProxy(lambda: get_batch_provider(uri, 10, rpc_slots))
+        web3 = Web3(provider)
+
+        run_concurrently(lambda i: web3.parity.traceBlock(i), num_threads=8)
+
+    assert server.max_in_flight == 2
+
+
+def test_rpc_slots_limit_batch_requests():
+    with slow_json_rpc_server() as server:
+        uri = f"http://127.0.0.1:{server.server_address[1]}"
+        rpc_slots = threading.BoundedSemaphore(2)
+        provider = ThreadLocalProxy(lambda: get_batch_provider(uri, 10, rpc_slots))
+        batch = json.dumps([{"jsonrpc": "2.0", "method": "eth_blockNumber", "id": 0}])
+
+        run_concurrently(lambda i: provider.make_batch_request(batch), num_threads=8)
+
+    assert server.max_in_flight == 2
+
+
+def test_requests_are_not_limited_without_rpc_slots():
+    with slow_json_rpc_server() as server:
+        uri = f"http://127.0.0.1:{server.server_address[1]}"
+        provider = ThreadLocalProxy(lambda: get_batch_provider(uri, 10))
+        web3 = Web3(provider)
+
+        run_concurrently(lambda i: web3.parity.traceBlock(i), num_threads=8)
+
+    assert server.max_in_flight > 2